@@ -1,10 +1,19 @@
 import numpy as np
-import pandas as pd
 from datetime import datetime
 from gurobipy import *
 
+__all__ = ['PrelimExamAssignment', 'ColumnGenerationSolver']
+
 class PrelimExamAssignment():
 
+    # Gurobi parameters for this class of assignment IP: the rooms are largely interchangeable,
+    # so aggressive symmetry detection, cuts and presolve pay off
+    default_params = {"Presolve" : 2,
+                      "Cuts" : 2,
+                      "Symmetry" : 2,
+                      "Method" : 2,
+                      "MIPGap" : 1e-3}
+
     def __init__(self,
                 room_label_dict,
                  exams,
@@ -14,9 +23,12 @@ class PrelimExamAssignment():
                  dist,
                  wr = 1,
                  w_ac = 0.05,
-                 R = 10):
+                 R = 10,
+                 params = None):
         '''
         Inputs:
+        - room_label_dict: no longer used, the rooms are identified by their room_id. Kept so
+          existing calls still work
         - exams: dataframe with each prelim that must be scheduled. Should have the following fields:
             - exam_id: the unique id for this prelim
             - enrollment: the enrollment for this course
@@ -34,6 +46,7 @@ class PrelimExamAssignment():
         - acadorg_dist: a dataframe with the distance from an acadorg to any building
         - dist: a dataframe with the distance from any building to another
         - R: the maximum number of rooms a single prelim can occupy
+        - params: dictionary of Gurobi parameters, overriding default_params
         '''
 
         # save parameters
@@ -42,31 +55,50 @@ class PrelimExamAssignment():
         self.R = R
         self.wr = wr
         self.w_ac = w_ac
+        self.params = {**self.default_params, **(params or {})}
 
         # set up exams dataframe
         self.exams = exams.rename(columns={"enrollment": "n"})
-        self.exams.loc[self.exams.modality == 'Online','n'] = 0 # set enrollment of online classes to 0
-        self.M = len(self.exams)
-
-        # set up rooms dataframe and add a dummy room for the online exams
-        self.rooms = (rooms.rename(columns={"capacity": "s"})
-                           .assign(b = 1)
-                           .append(pd.DataFrame([{"room_id" : "dummy",
-                                                  "building" : "dummy",
-                                                  "s" : 0,
-                                                  "b" : self.M}]))
-                           .reset_index().drop(columns=['index']))[['room_id','building', 'room', 's', 'b']]
-        self.N = len(self.rooms)
-
-        # add dummy building to distance matrix
-        self.acadorg_dist = acadorg_dist
-        self.acadorg_dist['dummy'] = 0.0
-
-        # add dummy buildings to buidling to building distance matrix
-        self.dist = dist
-        self.dist['dummy'] = 0.0
-        self.dist = self.dist.append(pd.Series(0, index=self.dist.columns), ignore_index=True)
-        self.dist.index = self.dist.columns
+        is_online = self.exams['modality'].to_numpy() == 'Online'
+        n = self.exams['n'].to_numpy(copy = True)
+        n[is_online] = 0 # set enrollment of online classes to 0
+        self.exams['n'] = n
+
+        # online exams don't need physical rooms, they all go to the dummy room (b(dummy) = M), so
+        # the model only has variables and constraints for the in person exams and the real rooms
+        self.exams_in_person = self.exams[~is_online]
+        self.exams_online = self.exams[is_online]
+        self.online_assignment = [(i, "dummy") for i in self.exams_online['exam_id']]
+        self.M = len(self.exams_in_person)
+        self.enrollments = self.exams_in_person['n'].to_numpy(np.int64)
+
+        # set up rooms. Rooms are only read column by column, so each column is kept as its own
+        # array instead of the dataframe
+        self.N = len(rooms)
+        self.room_ids = rooms['room_id'].to_numpy()
+        self.room_caps = rooms['capacity'].to_numpy(np.int64)
+        self.room_uses = np.ones(self.N, np.int64) # b(r) = 1 for every real room
+
+        # building to building distance matrix, building_idx maps a building to its row/column
+        self.building_idx = {b: idx for idx, b in enumerate(dist.columns)}
+        self.dist_arr = dist.to_numpy()
+
+        # acadorg to building distance matrix, with its columns in the same order as dist_arr
+        # and acadorg_idx mapping an acadorg to its row
+        self.acadorg_idx = {a: idx for idx, a in enumerate(acadorg_dist.index)}
+        self.acadorg_arr = acadorg_dist[dist.columns].to_numpy()
+
+        # row of each exam's acadorg and each room's building in the arrays above
+        self.exam_acadorg_idx = self.exams_in_person['acadorg'].map(self.acadorg_idx).to_numpy(np.int64)
+        self.room_building_idx = rooms['building'].map(self.building_idx).to_numpy(np.int64)
+
+        # row/column of each exam/room in the variable matrices
+        self.exam_ids = self.exams_in_person['exam_id'].to_numpy()
+        self.exam_idx = {i: idx for idx, i in enumerate(self.exam_ids)}
+        self.room_idx = {r: idx for idx, r in enumerate(self.room_ids)}
+
+        # objective coefficients, shared by every model built from this instance
+        self.aca, self.d2 = self.objective_coefficients()
 
 
     def build_model(self):
@@ -74,6 +106,7 @@ class PrelimExamAssignment():
         Function that creates the IP model
         '''
         self.model = Model("ip_1")
+        self.set_params()
 
         # initialize the decision variables
         self.init_dv()
@@ -84,40 +117,29 @@ class PrelimExamAssignment():
         #Set Objective
         self.set_objective()
 
+    def set_params(self):
+        '''
+        Applies the Gurobi parameters to the model
+        '''
+        for name, value in self.params.items():
+            self.model.setParam(name, value)
+
     def init_dv(self):
         '''
         Defines the decision variables
         '''
         # Define x(i,r) indicating if prelim i is assigned to room r
-        self.index_x = []
-        for i in self.exams['exam_id']:
-            for r in self.rooms['room_id']:
-                self.index_x.append((i,r))
-
-        self.x = self.model.addVars(self.index_x,vtype=GRB.BINARY, name = "x")
+        self.x = self.model.addMVar((self.M, self.N), vtype=GRB.BINARY, name = "x")
         # Define z(i) indicating the number of rooms prelim i is assigned to
-        self.index_z = []
-        for i in self.exams['exam_id']:
-            self.index_z.append((i))
-        self.z = self.model.addVars(self.index_z,vtype=GRB.INTEGER, name = "z")
-        # Define p(r,r') to indicate if room r and r' are assigned to the same prelim
-        self.index_p = []
-        room_ids = self.rooms['room_id']
-        for i in range(len(self.rooms['room_id'])):
-            for j in range(i, len(self.rooms['room_id'])):
-
-                self.index_p.append((room_ids[i],room_ids[j]))
-
-        self.p = self.model.addVars(self.index_p, vtype = GRB.BINARY, name = "p")
-        #print(self.index_x)
-        #print(self.index_z)
-        #print(self.index_p)
+        self.z = self.model.addMVar(self.M, vtype=GRB.INTEGER, name = "z")
+        # p(r,r') of the original model is not needed: the squared distances are charged
+        # on the products x(i,r)*x(i,r') in the objective and Gurobi linearizes them itself
+
     def add_constraints(self):
         '''
         Function to add all the constraints
         '''
         self.add_z_constraint()
-        self.add_p_constraint()
         self.add_absolute_room_bound_constraint()
         self.add_room_use_constraint()
         self.add_enrollment_const()
@@ -126,35 +148,16 @@ class PrelimExamAssignment():
         '''
         Add constraint to ensure z represents the number of classes a prelim is assigned to
         '''
-        for i in self.exams['exam_id']:
-            #print(self.z.get(i))
-            #print(len(self.x.select(i,'*')))
-            self.model.addConstr(sum(self.x.select(i,'*')), GRB.EQUAL, self.z[i], name = "c0")
+        self.model.addConstr(self.x.sum(axis = 1) == self.z, name = "c0")
         print('add_z_constraint')
 
         return
 
-    def add_p_constraint(self):
-        ''''
-        Add constraint to ensure p is 1 iff two rooms are assigned to the same prelim
-        '''
-        room_ids = self.rooms['room_id']
-        for i in self.exams['exam_id']:
-            for j in range(len(self.rooms['room_id'])):
-                r = self.rooms['room_id'][j]
-                for k in range(j, len(self.rooms['room_id'])):
-                    r_prime = self.rooms['room_id'][k]
-                    self.model.addConstr(self.p[r,r_prime] >= self.x[i,r] + self.x[i,r_prime] - 1)
-        print('add_p_constraint')
-        return
-
     def add_absolute_room_bound_constraint(self):
         ''''
         Add constraint to ensure a single prelim is assigned to at most R rooms
         '''
-        for i in self.exams['exam_id']:
-            #print(self.z.select(i))
-            self.model.addConstr(self.z[i]<= self.R)
+        self.model.addConstr(self.z <= self.R)
         print('add_absolute_room_bound_constraint')
         return
 
@@ -162,10 +165,7 @@ class PrelimExamAssignment():
         ''''
         Add constraint to ensure each room r is only once
         '''
-
-        for i in range(len(self.rooms['room_id'])):
-            r = self.rooms['room_id'][i]
-            self.model.addConstr(sum(self.x.select('*',r)), GRB.LESS_EQUAL, 1)
+        self.model.addConstr(self.x.sum(axis = 0) <= self.room_uses)
         print('add_room_use_constraint')
         return
 
@@ -173,12 +173,37 @@ class PrelimExamAssignment():
         ''''
         Add constraint to ensure each exam is given enough seats (only applies to in person)
         '''
-        exams = self.exams.reset_index(drop = True)
-        for idx,exam_i in enumerate(exams['exam_id']):
-                   self.model.addConstr(sum(self.rooms["s"])*sum(self.x.select(exam_i,'*')), GRB.GREATER_EQUAL,exams['n'][idx])
+        self.model.addConstr(self.x @ self.room_caps >= self.enrollments, name = "enrollment")
         print('add_enrollment_const')
         return
 
+    def objective_coefficients(self):
+        '''
+        Returns the objective coefficients shared by every formulation:
+        - aca: M x N array with w_ac * d(r, acadorg_i) for every exam i and room r
+        - d2: N x N array with the squared distance d(r,r')^2 between every two rooms
+        '''
+        aca = self.w_ac*self.acadorg_arr[np.ix_(self.exam_acadorg_idx, self.room_building_idx)]
+        # square the building distances before expanding them to rooms: there are far fewer
+        # buildings than rooms
+        d2 = (self.dist_arr**2)[np.ix_(self.room_building_idx, self.room_building_idx)]
+        return aca, d2
+
+    def squared_dist_term(self, x_i, i):
+        '''
+        Returns sum over r,r' of d(r,r')^2 x_i(r) x_i(r') for the room variables x_i of exam i.
+        A room that can seat the whole exam is never used next to another room in an optimal
+        solution: dropping the other rooms keeps it feasible and, as wr > 0 and w_ac >= 0,
+        lowers the cost. So only pairs of rooms smaller than the enrollment are included, which
+        leaves out the products Gurobi would otherwise linearize for pairs that can't occur.
+        '''
+        rooms = np.arange(self.N)
+        if self.wr > 0 and self.w_ac >= 0:
+            rooms = rooms[self.room_caps < self.enrollments[i]]
+        if len(rooms) < 2:
+            return 0
+        return (x_i[rooms] @ self.d2[np.ix_(rooms, rooms)] @ x_i[rooms]).item()
+
     def set_objective(self):
         ''''
         Set the objective for the IP
@@ -187,45 +212,217 @@ class PrelimExamAssignment():
         # (1) total number of rooms used
         # (2) distance of rooms to academin org of class
         # (3) squared distances between rooms assigned to the same prelim
-        academic_org_dist = []
-        #second summation in the objective
-        for room in self.acadorg_dist.columns:
-            #get each distance from the room
-            for dist_aca in self.acadorg_dist[room]:
-                #get exam id
-                for i in self.exams['exam_id']:
-                    #map to room index
-                    room_id_list = self.room_label_dict[room]
-                    for true_id in room_id_list:
-                        #add constraint to list
-                        unit = self.x[i,true_id]*dist_aca*self.w_ac
-                        academic_org_dist.append(unit)
-
-        squared_dist_constraint = []
-        for r in self.dist.columns:
-            for distance in self.dist[r]:
-                room_id_list = self.room_label_dict[r]
-                for r_true_id in room_id_list:
-                    unit = (distance**2)*sum(self.p.select(r_true_id ,'*'))
-                    squared_dist_constraint.append(unit)
-
-        self.model.setObjective(self.wr*quicksum(self.z) , GRB.MINIMIZE)
+        # (2) coefficient w_ac * d(r, acadorg_i) for every x(i,r)
+        academic_org_dist = (self.aca*self.x).sum()
+
+        # (3) sum over r,r' of d(r,r')^2 x(i,r) x(i,r') for every exam. d2 is symmetric, so every
+        # unordered pair is counted twice, as in the sum over p(r,r')
+        squared_dist_constraint = quicksum(self.squared_dist_term(self.x[i], i) for i in range(self.M))
+
+        self.model.setObjective(self.wr*self.z.sum() + academic_org_dist + squared_dist_constraint,
+                                GRB.MINIMIZE)
         self.model.update()
 
 
-    def solve(self):
+    def start_values(self, warm_start):
+        '''
+        Converts a warm start to a dictionary of (exam row, room column) -> value of x.
+        warm_start is either the list of (exam_id, room_id) returned by a previous solve(),
+        or a dictionary of (exam_id, room_id) -> 0/1. Exams or rooms not in this model are skipped.
+        '''
+        if not isinstance(warm_start, dict):
+            warm_start = {key: 1 for key in warm_start}
+        return {(self.exam_idx[i], self.room_idx[r]): value for (i,r), value in warm_start.items()
+                if i in self.exam_idx and r in self.room_idx}
+
+    def solve(self, warm_start = None):
         ''''
         Function to solve the IP problem
+        - warm_start: optional previous assignment used as the MIP start, see start_values()
         '''
+        if warm_start is not None:
+            # an exam given at least one room has all its other rooms set to 0, the values of
+            # any other exam are left for Gurobi to complete
+            start = np.full((self.M, self.N), GRB.UNDEFINED)
+            values = self.start_values(warm_start)
+            start[[i for (i,r), value in values.items() if value > 0.5], :] = 0
+            for (i,r), value in values.items():
+                start[i,r] = value
+            self.x.Start = start
+            # favour improving the start over proving optimality, unless params says otherwise
+            for name, value in (("MIPFocus", 1), ("Heuristics", 0.2)):
+                if name not in self.params:
+                    self.model.setParam(name, value)
+            self.model.update()
+
         # Solve the model
         self.model.optimize()
-        obj = self.model.getObjective()
+        if self.model.SolCount == 0:
+            return []
 
-        print(self.exams.columns)
-        x_vars_with_value_1 = []
-        for result in (self.x):
-            if 'value 1.0' in str(self.x[result]):
-                x_vars_with_value_1.append(result)
+        exams, rooms = np.nonzero(self.x.X > 0.5)
+        return list(zip(self.exam_ids[exams], self.room_ids[rooms])) + self.online_assignment
+
+
+class ColumnGenerationSolver(PrelimExamAssignment):
+    '''
+    Solves the same model as PrelimExamAssignment by column generation.
+
+    The master problem picks one room package (a set of rooms) per exam, subject to each
+    room being used at most b(r) times. Packages are priced by one small IP per exam over
+    the rooms, with the same objective as the full model restricted to that exam:
+        wr * |S| + sum_{r in S} w_ac * d(r, acadorg_i) + sum_{r,r' in S} d(r,r')^2
+    Once no package has negative reduced cost, the master is solved as an IP over the
+    generated packages, so the result is a heuristic solution to the full model.
+    '''
+
+    # primal simplex restarts the LP master from the previous basis after columns are added
+    default_params = {**PrelimExamAssignment.default_params, "Method" : 0}
+
+    # cost of leaving an exam without rooms in the master, keeps it feasible from the start
+    unassigned_cost = 1e4
+    max_iterations = 200
+
+    def build_model(self):
+        '''
+        Creates the master problem and one pricing problem per exam
+        '''
+        self.model = Model("master")
+        self.set_params()
+        self.assign_constrs = [self.model.addLConstr(LinExpr(), GRB.EQUAL, 1, name = "assign")
+                               for i in range(self.M)]
+        self.room_constrs = [self.model.addLConstr(LinExpr(), GRB.LESS_EQUAL, b, name = "room_use")
+                             for b in self.room_uses]
+        self.unassigned = [self.model.addVar(obj = self.unassigned_cost, ub = 1,
+                                             column = Column([1], [self.assign_constrs[i]]),
+                                             name = "unassigned")
+                           for i in range(self.M)]
+        # a[k] selects package k, which assigns the rooms in package_rooms[k] to exam package_exam[k]
+        self.a = []
+        self.package_exam = []
+        self.package_rooms = []
+        self.packages = set()
+
+        self.pricing = []
+        for i in range(self.M):
+            sub = Model("pricing")
+            sub.Params.OutputFlag = 0
+            y = sub.addMVar(self.N, vtype = GRB.BINARY, name = "y")
+            sub.addConstr(self.room_caps @ y >= self.enrollments[i])
+            sub.addConstr(y.sum() <= self.R)
+            # the linear part is reset from the duals before every solve
+            sub.setObjective(self.squared_dist_term(y, i), GRB.MINIMIZE)
+            self.pricing.append((sub, y))
+
+    def package_cost(self, i, rooms):
+        '''
+        Returns the objective cost of assigning exam i to the given room indices
+        '''
+        return (self.wr*len(rooms) + self.aca[i, rooms].sum()
+                + self.d2[np.ix_(rooms, rooms)].sum())
+
+    def add_package(self, i, rooms):
+        '''
+        Adds the column of exam i using the given room indices to the master problem
+        '''
+        cost = self.package_cost(i, rooms)
+        column = Column([1]*(len(rooms) + 1),
+                        [self.assign_constrs[i]] + [self.room_constrs[r] for r in rooms])
+        self.a.append(self.model.addVar(obj = cost, ub = 1, column = column, name = "a"))
+        self.package_exam.append(i)
+        self.package_rooms.append(rooms)
+        self.packages.add((i, tuple(rooms)))
+
+    def add_priced_packages(self, i, sub, y, assign_dual, room_duals):
+        '''
+        Adds every new package in the solution pool of the pricing problem of exam i that has
+        negative reduced cost, and returns how many were added. Reduced costs are recomputed from
+        the full package cost, as the pricing objective leaves out pairs of large rooms
+        '''
+        added = 0
+        for k in range(sub.SolCount):
+            sub.Params.SolutionNumber = k
+            rooms = np.flatnonzero(y.Xn > 0.5)
+            if (i, tuple(rooms)) in self.packages:
+                continue
+            if self.package_cost(i, rooms) - assign_dual - room_duals[rooms].sum() < -1e-6:
+                self.add_package(i, rooms)
+                added += 1
+        return added
+
+    def generate_columns(self):
+        '''
+        Solves the LP master and adds every package with negative reduced cost until none is left
+        '''
+        for iteration in range(self.max_iterations):
+            self.model.optimize()
+            assign_duals = np.array(self.model.getAttr("Pi", self.assign_constrs))
+            room_duals = np.array(self.model.getAttr("Pi", self.room_constrs))
+
+            added = 0
+            for i, (sub, y) in enumerate(self.pricing):
+                y.Obj = self.wr + self.aca[i] - room_duals
+                # any package with negative reduced cost will do, no need to prove the best one
+                sub.Params.BestObjStop = assign_duals[i] - 1e-6
+                sub.optimize()
+                new = self.add_priced_packages(i, sub, y, assign_duals[i], room_duals)
+                if new == 0 and sub.Status == GRB.USER_OBJ_LIMIT:
+                    # what the early stop found is already in the master, so solve to optimality
+                    # to prove no other package improves it
+                    sub.Params.BestObjStop = -GRB.INFINITY
+                    sub.optimize()
+                    new = self.add_priced_packages(i, sub, y, assign_duals[i], room_duals)
+                added += new
+            print('column generation iteration', iteration, 'added', added)
+            if added == 0:
+                break
+        if added > 0:
+            # the integer master is then solved over the packages generated so far
+            print('column generation stopped after', self.max_iterations,
+                  'iterations before pricing converged')
+
+    def solve(self, warm_start = None):
+        ''''
+        Function to solve the problem by column generation
+        - warm_start: optional previous assignment, whose packages seed the master problem
+        Exams that no generated package can seat are listed in unassigned_exams and left out
+        of the returned assignment.
+        '''
+        if warm_start is not None:
+            packages = {}
+            for (i,r), value in sorted(self.start_values(warm_start).items()):
+                if value > 0.5:
+                    packages.setdefault(i, []).append(r)
+            for i, rooms in packages.items():
+                # the master only sees room use, so packages that no longer seat the exam or
+                # exceed R rooms (e.g. after enrollments changed) must not be offered to it
+                rooms = np.array(rooms)
+                if self.room_caps[rooms].sum() < self.enrollments[i] or len(rooms) > self.R:
+                    continue
+                if (i, tuple(rooms)) not in self.packages:
+                    self.add_package(i, rooms)
+
+        self.generate_columns()
+
+        # integer master over the generated packages
+        variables = self.a + self.unassigned
+        self.model.setAttr("VType", variables, [GRB.BINARY]*len(variables))
+        self.model.optimize()
+        values = self.model.getAttr("X", variables) if self.model.SolCount > 0 else None
+        # back to the LP master, so solve() can be called again with more columns. The change
+        # is only applied at the next update, so the integer solution can still be queried
+        self.model.setAttr("VType", variables, [GRB.CONTINUOUS]*len(variables))
+        if values is None:
+            return []
 
+        # exams no generated package could fit are left out of the assignment, but the
+        # other exams keep their rooms
+        package_values, unassigned_values = values[:len(self.a)], values[len(self.a):]
+        self.unassigned_exams = [self.exam_ids[i] for i, value in enumerate(unassigned_values)
+                                 if value > 0.5]
+        if self.unassigned_exams:
+            print('could not assign rooms to', self.unassigned_exams)
 
-        return x_vars_with_value_1
+        return [(self.exam_ids[i], self.room_ids[r])
+                for value, i, rooms in zip(package_values, self.package_exam, self.package_rooms)
+                if value > 0.5 for r in rooms] + self.online_assignment